@@ -3,38 +3,87 @@
 # This script runs the local version of (PSI-)BLAST.
 
 import argparse
+import array
+import collections
+import concurrent.futures
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
 import subprocess
-import math
+import tempfile
+from pathlib import Path
 import numpy
-import itertools
-import matplotlib
-matplotlib.use('AGG')
-import pylab
 
+# Number of output lines that are joined and written at once by write_output().
+OUTPUT_BATCH_SIZE = 65536
 
-def blast(db, query, query_folder="./queries/", blast_path="", psiblast=False, evalue=10):
+# Matches the accession in a sequence id like "sp|P12345|NAME_HUMAN".
+ACCESSION_PATTERN = re.compile(r"\|([^|]+)\|")
+
+# All (PSI-)BLAST hits of a run, stored as parallel arrays instead of a dictionary of tuples:
+# the i-th hit is the pair (query_idx[i], subject_idx[i]) with e-value evalues[i]. The indices
+# refer to id2idx, which maps each UniProt ID to its index; the IDs of the uniprot_id_list come first.
+BlastHits = collections.namedtuple("BlastHits", ["id2idx", "query_idx", "subject_idx", "evalues"])
+
+
+def ensure_blastdb(db, blast_path=""):
+    """
+    This function formats the fasta database with makeblastdb, unless an up-to-date index already exists.
+    The index files are written next to the fasta file, so db can be passed to (PSI-)BLAST as is.
+    :param db: database filename (fasta); if it does not exist, db is assumed to be a formatted database
+    :param blast_path: folder containing the blast executables; empty to look them up in PATH
+    """
+    if not os.path.exists(db):
+        return
+    db_mtime = os.path.getmtime(db)
+    for extension in (".phr", ".pin", ".psq"):
+        index = db + extension
+        if not os.path.exists(index) or os.path.getmtime(index) < db_mtime:
+            cmd = [os.path.join(blast_path, "makeblastdb"), "-in", db, "-dbtype", "prot", "-parse_seqids"]
+            # Only the progress report on stdout is hidden; errors on stderr stay visible to the user.
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+            return
+
+
+def get_accession(seq_id):
+    """
+    This function returns the accession of a sequence id as reported by (PSI-)BLAST.
+    Depending on how the database was formatted this is either "sp|P12345|NAME_HUMAN" or just "P12345".
+    """
+    match = ACCESSION_PATTERN.search(seq_id)
+    if match:
+        return match.group(1)
+    return seq_id
+
+
+def blast(db, query, blast_path="", psiblast=False, evalue=10, num_threads=os.cpu_count(), pssm_cache=None,
+          max_target_seqs=None):
     """
     This function executes blast or psi-blast for the given query and db.
     :param db: database filename
-    :param query: query filename
-    :param query_folder: query folder name
-    :param blast_path: path to the blast
+    :param query: path to the query (multi-)fasta file
+    :param blast_path: folder containing the blast executables; empty to look them up in PATH
     :param psiblast: True if PSI-BLAST should be used; False for normal BLAST
-    :return: result from blast run
+    :param num_threads: number of threads (CPUs) used by the (PSI-)BLAST search
+    :param pssm_cache: folder where PSI-BLAST profiles (PSSMs) are saved and reused; None disables the cache.
+                       A profile is reused for the same query sequence, database (path and modification time),
+                       evalue and max_target_seqs.
+    :param max_target_seqs: maximum number of hits reported per query; None keeps the default of (PSI-)BLAST
+    :return: dictionary storing protein pair as tuple (keys) and the corresponding e-value (values)
     """
-    if query.endswith("\n"):
-        query = query[0:-1]
-    if query.endswith(" "):
-        query = query[0:-1]
+    pssm_tmp = None
     if not psiblast:
         ##########################
         ### START CODING HERE ####
         ##########################
-        # Define the variable 'cmd' as a string with the command for BLASTing 'query' against
+        # Define the variable 'cmd' as the argument list of the command for BLASTing 'query' against
         # the specified database 'db'.
         # Note that it is is easier to parse the output if it is in tabular format.
         # For that use can use the option -outfmt '6 qacc sacc evalue'. (see https://www.ncbi.nlm.nih.gov/books/NBK279682/ )
-        cmd = "blastp -query=" + query_folder + query + " -db=" + db + " -outfmt=\"6 qacc sacc evalue\" -evalue=" + evalue 
+        cmd = [os.path.join(blast_path, "blastp"), "-query", query, "-db", db, "-outfmt", "6 qacc sacc evalue",
+               "-evalue", str(evalue), "-num_threads", str(num_threads)]
 
         ##########################
         ###  END CODING HERE  ####
@@ -44,41 +93,77 @@ def blast(db, query, query_folder="./queries/", blast_path="", psiblast=False, e
         ##########################
         ### START CODING HERE ####
         ##########################
-        # Define the variable 'cmd' as a string with the command for PSI-BLASTing 'query' against
+        # Define the variable 'cmd' as the argument list of the command for PSI-BLASTing 'query' against
         # the specified database 'db'.
         # To avoid the warning about composition based statistics, we disabled them with -comp_based_stats 0
-        cmd = "psiblast -query=" + query_folder + query + " -db=" + db + " -num_iterations=3" + " -outfmt=\"6 qacc sacc evalue\" -evalue=" + evalue + " -comp_based_stats=0"
+        cmd = [os.path.join(blast_path, "psiblast"), "-db", db,
+               "-outfmt", "6 qacc sacc evalue", "-evalue", str(evalue), "-comp_based_stats", "0",
+               "-num_threads", str(num_threads)]
+        # The profile built for a single-sequence query only depends on the query sequence, the database and
+        # the settings that decide which hits are included in it, so it is saved after the first run and later runs start from it instead of iterating again.
+        # psiblast saves the profile that was used for the last search round (not the one built after it),
+        # so searching once with the saved profile gives the same hits as a run without the cache.
+        pssm_file = None
+        if pssm_cache is not None:
+            pssm_key = repr((hash_file(query), os.path.abspath(db), get_db_mtime(db), float(evalue), max_target_seqs))
+            pssm_file = os.path.join(pssm_cache, hashlib.sha1(pssm_key.encode()).hexdigest() + ".pssm")
+        if pssm_file is not None and os.path.exists(pssm_file):
+            cmd += ["-in_pssm", pssm_file]
+        else:
+            cmd += ["-query", query, "-num_iterations", "3"]
+            if pssm_file is not None:
+                # Write to a temporary file first, so a failed or killed run never leaves a partial profile behind
+                fd, pssm_tmp = tempfile.mkstemp(suffix=".pssm.tmp", dir=pssm_cache)
+                os.close(fd)
+                cmd += ["-out_pssm", pssm_tmp]
         #print("We are in PSI blast")
         ##########################
         ###  END CODING HERE  ####
         ##########################
-    # Running shell command in python script. See https://docs.python.org/2/library/subprocess.html#popen-constructor
-    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                         close_fds=True)
-    blast_result = p.stdout.read()
-    return blast_result
+    if max_target_seqs is not None:
+        cmd += ["-max_target_seqs", str(max_target_seqs)]
+    # Running the command without a shell in between. See https://docs.python.org/3/library/subprocess.html#popen-constructor
+    # The output is parsed line by line while (PSI-)BLAST is still running, instead of buffering all of it.
+    # The with block closes the pipe and waits for (PSI-)BLAST, also when parsing fails.
+    try:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1) as p:
+            blast_dict = parse_blast_result(blast_result=p.stdout, blast_dict={})
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+        if pssm_tmp is not None and os.path.getsize(pssm_tmp) > 0:
+            os.replace(pssm_tmp, pssm_file)
+    finally:
+        if pssm_tmp is not None and os.path.exists(pssm_tmp):
+            os.remove(pssm_tmp)
+    return blast_dict
 
 
 def parse_blast_result(blast_result, blast_dict):
     """
-    This function parses the output of (PSI-)BLAST and stores the result in blast_dict (defined in main()).
-    :param blast_result: output  obtained after running (PSI-)BLAST
+    This function parses the output of (PSI-)BLAST and stores the result in blast_dict (defined in blast()).
+    :param blast_result: output obtained after running (PSI-)BLAST, as an iterable of lines (e.g. its stdout)
     :param blast_dict: dictionary where the sequence's alignments will be stored [Keys: (id1,id2) Values: E-values]
     :return: dictionary storing protein pair as tuple (keys) and the corresponding e-value (values)
     """
-    for line in blast_result.split("\n"):
+    # Bind the names used for every line locally, which avoids the global/attribute lookups in this hot loop
+    _accession = get_accession
+    _float = float
+    _dict = blast_dict
+    for line in blast_result:
+        line = line.rstrip("\n")
         if line and line[0] != "#" and line[0] != "[":
             try:
-                splitted_line = line.split()
-                query = splitted_line[0].split("|")[1]
-                subject = splitted_line[1].split("|")[1]
+                # The tabular output has exactly three tab separated columns: qacc, sacc and evalue
+                splitted_line = line.split("\t", 2)
+                query = _accession(splitted_line[0])
+                subject = _accession(splitted_line[1])
                 e_value = splitted_line[2]
                 ##########################
                 ### START CODING HERE ####
                 ##########################
                 # Parse the e-score corresponding to this line's (query, subject) pair and store it in blast_dict.
                 blast_key = (query, subject)
-                blast_dict[blast_key] = float(e_value) 
+                _dict[blast_key] = _float(e_value)
                 ##########################
                 ###  END CODING HERE  ####
                 ##########################
@@ -89,104 +174,334 @@ def parse_blast_result(blast_result, blast_dict):
     return blast_dict
 
 
-def write_output(uniprot_ids, output_filename, blast_dict):
+def new_blast_hits(uniprot_ids):
+    """
+    This function creates an empty BlastHits for the given UniProt IDs.
+    :param uniprot_ids: list of the UniProt IDs of the queries, without duplicates.
+    :return: BlastHits without any hit.
+    """
+    id2idx = {uniprot_id: i for i, uniprot_id in enumerate(uniprot_ids)}
+    return BlastHits(id2idx, array.array("i"), array.array("i"), array.array("d"))
+
+
+def add_hits(blast_hits, hits):
+    """
+    This function appends hits to blast_hits. IDs that are not known yet (e.g. subjects that are not in the
+    uniprot_id_list) get a new index.
+    :param blast_hits: BlastHits the hits are added to.
+    :param hits: iterable of (query, subject, e-value) tuples.
+    """
+    id2idx = blast_hits.id2idx
+    for query, subject, e_value in hits:
+        blast_hits.query_idx.append(id2idx.setdefault(query, len(id2idx)))
+        blast_hits.subject_idx.append(id2idx.setdefault(subject, len(id2idx)))
+        blast_hits.evalues.append(e_value)
+
+
+def write_output(uniprot_ids, output_filename, blast_hits, sparse=False):
     """
     This function writes the scores of all-against-all protein pairs to the output file.
-    :param blast_result: output result obtained after running (PSI-)BLAST.
-    :param blast_dict: dictionary where the sequence's alignments will be stored [Keys: (id1,id2) Values: E-values].
-    :return: dictionary storing protein pair as tuple (keys) and the corresponding e-value (values).
+    :param uniprot_ids: list of the UniProt IDs of the queries.
+    :param output_filename: output file.
+    :param blast_hits: BlastHits containing all the sequences alignments and e-values.
+    :param sparse: if True, only the protein pairs with a hit are written; all missing pairs are implicitly NA.
     """
+    n = len(uniprot_ids)
+    query_idx = numpy.asarray(blast_hits.query_idx, dtype=numpy.intp)
+    subject_idx = numpy.asarray(blast_hits.subject_idx, dtype=numpy.intp)
+    e_values = numpy.asarray(blast_hits.evalues)
+    listed = (query_idx < n) & (subject_idx < n)
+    if sparse:
+        write_sparse_output(uniprot_ids, output_filename, query_idx[listed], subject_idx[listed], e_values[listed])
+        return
+
+    # Sort the hits between the listed IDs by query, so the e-values of one query at a time can be
+    # scattered in a single row; pairs without a hit stay NaN. This needs memory for one row and the
+    # hits instead of a whole n x n matrix. float64 is used because e-values can be much smaller than
+    # the smallest float32.
+    query_idx, subject_idx, e_values = query_idx[listed], subject_idx[listed], e_values[listed]
+    order = numpy.lexsort((subject_idx, query_idx))
+    query_idx, subject_idx, e_values = query_idx[order], subject_idx[order], e_values[order]
+    row_starts = numpy.searchsorted(query_idx, numpy.arange(n + 1))
+    row = numpy.empty(n)
+
     with open(output_filename, "w") as f:
-        # Generate all possible combinations of IDs
-        combinations_ids = itertools.product(uniprot_ids, uniprot_ids)
+        # Write all ordered pairs of two different IDs, in batches to avoid one write call per pair
+        lines = []
+        for i, query in enumerate(uniprot_ids):
+            row.fill(numpy.nan)
+            start, end = row_starts[i], row_starts[i + 1]
+            row[subject_idx[start:end]] = e_values[start:end]
+            prefix = query + "\t"
+            lines.extend(prefix + subject + "\t" + ("NA" if e_value != e_value else str(e_value))
+                         for j, (subject, e_value) in enumerate(zip(uniprot_ids, row.tolist())) if j != i)
+            if len(lines) >= OUTPUT_BATCH_SIZE:
+                f.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            f.write("\n".join(lines) + "\n")
+
 
-        for pair in combinations_ids:
-            # Check if the pair has unique elements
-            if len(pair) == len(set(pair)):
-                pair_str = "\t".join(pair)
-                if pair in blast_dict:
-                    f.write(pair_str + "\t" + str(blast_dict[pair]) + "\n")
-                else:
-                    f.write(pair_str + "\t" + "NA\n")
+def write_sparse_output(uniprot_ids, output_filename, query_idx, subject_idx, e_values):
+    """
+    This function writes only the protein pairs that have a hit to the output file, in the same
+    format as write_output(). Pairs of two different IDs that are not in the file have no hit (NA).
+    :param uniprot_ids: list of the UniProt IDs of the queries.
+    :param output_filename: output file.
+    :param query_idx: array with the index in uniprot_ids of the query of every hit.
+    :param subject_idx: array with the index in uniprot_ids of the subject of every hit.
+    :param e_values: array with the e-value of every hit.
+    """
+    different = query_idx != subject_idx
+    query_idx, subject_idx, e_values = query_idx[different], subject_idx[different], e_values[different]
+    # Sort the hits by query and subject, so the output does not depend on the order the BLAST runs finished in
+    order = numpy.lexsort((subject_idx, query_idx))
+    with open(output_filename, "w") as f:
+        for start in range(0, len(order), OUTPUT_BATCH_SIZE):
+            batch = order[start:start + OUTPUT_BATCH_SIZE]
+            lines = [uniprot_ids[i] + "\t" + uniprot_ids[j] + "\t" + str(e_value)
+                     for i, j, e_value in zip(query_idx[batch].tolist(), subject_idx[batch].tolist(),
+                                              e_values[batch].tolist())]
+            f.write("\n".join(lines) + "\n")
 
 
-def plot_evalue_distribution(blast_dict, png_filename="DistributionEValue.png", evalue=100000):
+def plot_evalue_distribution(e_values, png_filename="DistributionEValue.png", evalue=100000):
     """
     This function plots the distribution of the log(e-value). pseudocount is added to avoid log(0).
     The pseudocount in this case is the smallest non-zero e-value divided by 1000.
-    :param blast_dict: dictionary containing all the sequences alignments and e-values [Keys: (id1,id2) Values: E-values]
+    :param e_values: array with the e-values of all the sequences alignments (e.g. BlastHits.evalues)
     :param png_filename: png output file to save the distribution plot.
     :param evalue: threshold for e-value. If no threshold specified, arbitrary 100000 will be used.
-
+    :return: number of e-values lower than the threshold.
     """
-    sorted_e_val = sorted(blast_dict.values())
-    nonzero_indices = numpy.nonzero(sorted_e_val)[0]
-    pseudo_count = sorted_e_val[nonzero_indices[0]] / 1000.0
-    
-    log_evalues = map(lambda x: math.log10(x + pseudo_count), blast_dict.values())
+    # matplotlib is only imported when plotting, so BLAST-only runs do not pay for it
+    import matplotlib
+    matplotlib.use('AGG')
+    from matplotlib import pyplot as plt
+
+    e_values = numpy.asarray(e_values, dtype=numpy.float64)
+    pseudo_count = e_values[e_values > 0].min() / 1000.0
+    log_evalues = numpy.log10(e_values + pseudo_count)
     ###Adding average log(evalue)####
-    pylab.title("Average log(e-value):" + str(numpy.mean(log_evalues)))
+    plt.title("Average log(e-value):" + str(log_evalues.mean()))
     #################################
-    pylab.hist(minus_log_evalues)
-    pylab.xlabel("log(e-value)")
-    pylab.ylabel("Frequency")
-    pylab.savefig(png_filename)
+    # Bin with numpy and only draw the bars, which stays fast for millions of protein pairs
+    counts, edges = numpy.histogram(log_evalues, bins=50)
+    plt.bar(edges[:-1], counts, width=numpy.diff(edges), align="edge")
+    plt.xlabel("log(e-value)")
+    plt.ylabel("Frequency")
+    plt.savefig(png_filename)
 
     ##########################
     ### START CODING HERE ####
     ##########################
     # Calculate the number of e-values lower than threshold.
     # You will need to figure out how to pass evalue to this function.
-    lower_than_threshold = 0
-    for e_value in sorted_e_val:
-    	if e_value < evalue:
-    		lower_than_threshold += 1
-
-    pass
+    lower_than_threshold = int((e_values < evalue).sum())
+    return lower_than_threshold
     ##########################
     ###  END CODING HERE  ####
     ##########################
 
-def clean_uniprot(uniprot):
-    """
-    This function is used to get rid of extra spaces and line breaks
-    when processing the uniprot ids lisr file
-    """
-    if uniprot.endswith("\n"):
-        uniprot = uniprot[0:-1]
-    if uniprot.endswith(" "):
-        uniprot = uniprot[0:-1]
-    return uniprot
-def main(uniprot_id_list, query_folder, db, psiblast, output_filename, output_png="", evalue=10):
-    # The blast_dict dictionary will be used to store protein pair and the corresponding e-value.
-    # Keys for blast_dict are the combination of query and subject/hit, e.g.:
-    # key             = (query, subject)
-    # blast_dict[key] = e_value
-    blast_dict = {}
+def open_blast_cache(cache_filename):
+    """
+    This function opens (and if needed creates) the SQLite file in which (PSI-)BLAST hits are cached between runs.
+    Table hits stores the e-value of every (query, subject) pair, table queries the queries that were
+    (PSI-)BLASTed, so that queries without any hit are not run again either.
+    :param cache_filename: filename of the SQLite cache.
+    :return: connection to the cache.
+    """
+    conn = sqlite3.connect(cache_filename)
+    conn.execute("CREATE TABLE IF NOT EXISTS hits"
+                 "(query TEXT, subject TEXT, evalue REAL, params TEXT, PRIMARY KEY(query, subject, params))")
+    conn.execute("CREATE TABLE IF NOT EXISTS queries(query TEXT, params TEXT, PRIMARY KEY(query, params))")
+    return conn
+
+
+def get_db_mtime(db):
+    """
+    This function returns the modification time of the database: of the fasta file if it exists,
+    otherwise of the formatted database. None if neither exists.
+    :param db: database filename
+    """
+    db_file = db if os.path.exists(db) else db + ".pin"
+    return os.path.getmtime(db_file) if os.path.exists(db_file) else None
+
+
+def get_cache_params(db, evalue, psiblast, max_target_seqs, pssm_cache=None):
+    """
+    This function summarizes the settings that change the (PSI-)BLAST hits of a query in a single hash.
+    Cached hits are only reused for the same hash, so they are invalidated when the database changes.
+    :param db: database filename
+    :param evalue: e-value threshold
+    :param psiblast: True if PSI-BLAST is used; False for normal BLAST
+    :param max_target_seqs: maximum number of hits reported per query; None if (PSI-)BLAST's default is used
+    :param pssm_cache: folder of the PSI-BLAST profile cache; None if it is not used
+    :return: hex digest identifying the settings.
+    """
+    params = (os.path.abspath(db), get_db_mtime(db), float(evalue), bool(psiblast))
+    if max_target_seqs is not None:
+        params += (int(max_target_seqs),)
+    # A search that starts from a cached profile only reports the hits of the final round, while a normal
+    # PSI-BLAST run also reports the pairs found in earlier rounds, so the two are cached separately.
+    if psiblast and pssm_cache is not None:
+        params += ("pssm_cache",)
+    params = repr(params)
+    return hashlib.sha1(params.encode()).hexdigest()
+
+
+def hash_file(filename):
+    """
+    This function returns the SHA-1 hex digest of the content of a file.
+    """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_query_params(params, query_fasta):
+    """
+    This function extends the hash of the (PSI-)BLAST settings with the content of a query's fasta file,
+    so the cached hits of a query are not reused after its sequence was changed.
+    :param params: hash of the (PSI-)BLAST settings (see get_cache_params()).
+    :param query_fasta: fasta file of the query.
+    :return: hex digest identifying the settings and the query.
+    """
+    return hashlib.sha1((params + "\0" + hash_file(query_fasta)).encode()).hexdigest()
+
+
+def load_cached_hits(conn, query_params, blast_hits):
+    """
+    This function loads the cached hits of the queries that were already (PSI-)BLASTed into blast_hits.
+    :param conn: connection to the cache (see open_blast_cache()).
+    :param query_params: dictionary with the UniProt IDs of the queries (keys) and their hash (values)
+                         (see get_query_params()).
+    :param blast_hits: BlastHits the cached hits are added to.
+    :return: list of the UniProt IDs that are not in the cache and still have to be (PSI-)BLASTed.
+    """
+    missing_ids = []
+    for uniprot_id, params in query_params.items():
+        if conn.execute("SELECT 1 FROM queries WHERE query=? AND params=?", (uniprot_id, params)).fetchone() is None:
+            missing_ids.append(uniprot_id)
+            continue
+        add_hits(blast_hits, conn.execute("SELECT query, subject, evalue FROM hits WHERE query=? AND params=?",
+                                          (uniprot_id, params)))
+    return missing_ids
+
+
+def store_hits(conn, query_params, uniprot_ids, hits):
+    """
+    This function stores the hits of a (PSI-)BLAST run in the cache and marks its queries as done.
+    :param conn: connection to the cache (see open_blast_cache()).
+    :param query_params: dictionary with the UniProt IDs of the queries (keys) and their hash (values)
+                         (see get_query_params()).
+    :param uniprot_ids: UniProt IDs of the queries of the run.
+    :param hits: dictionary with the hits of the run [Keys: (id1,id2) Values: E-values].
+    """
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+                         [(query, subject, e_value, query_params[query])
+                          for (query, subject), e_value in hits.items() if query in query_params])
+        conn.executemany("INSERT OR REPLACE INTO queries VALUES (?, ?)",
+                         [(uniprot_id, query_params[uniprot_id]) for uniprot_id in uniprot_ids])
+
+
+def copy_file(src, dst):
+    """
+    This function appends the content of src to dst, letting the kernel copy the bytes with os.sendfile()
+    instead of reading them into Python. Falls back to a normal copy where sendfile is not supported.
+    :param src: file object opened for reading in binary mode.
+    :param dst: unbuffered file object opened for writing in binary mode.
+    """
+    offset = 0
+    size = os.fstat(src.fileno()).st_size
+    try:
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        src.seek(offset)
+        shutil.copyfileobj(src, dst)
+
+
+def concatenate_queries(query_folder, uniprot_ids, output_fasta):
+    """
+    This function concatenates the fasta files of the given queries into a single multi-fasta file.
+    :param query_folder: query folder name
+    :param uniprot_ids: UniProt IDs of the queries; the fasta file of each one is query_folder/<id>.fasta
+    :param output_fasta: filename of the multi-fasta file to write
+    """
+    # The file is unbuffered, so the newlines written from Python and the bytes copied
+    # by the kernel with os.sendfile() end up in the right order.
+    with open(output_fasta, "wb", buffering=0) as f:
+        for uniprot_id in uniprot_ids:
+            with open(os.path.join(query_folder, uniprot_id + ".fasta"), "rb") as query_fasta:
+                copy_file(query_fasta, f)
+            f.write(b"\n")
+
+
+def main(uniprot_id_list, query_folder, db, psiblast, output_filename, output_png="", evalue=10, threads=None,
+         pssm_cache=None, max_target_seqs=None, sparse=False, use_cache=True):
+    # Format the database once, instead of letting every (PSI-)BLAST run parse the fasta file.
+    ensure_blastdb(db)
+
     # uniprot_ids is a list to store all UniProt IDs contained in uniprot_id_list.
-    uniprot_ids = []
+    # Splitting on any whitespace drops line breaks, extra spaces and empty lines at once.
+    # Duplicated IDs are only kept once (in order), so every ID has a single row/column in the output
+    # and no pair of an ID with itself is written.
+    uniprot_ids = list(dict.fromkeys(Path(uniprot_id_list).read_text().split()))
 
-    uniprot_ids_file = open(uniprot_id_list)
-    for line in uniprot_ids_file:
-        query = line.strip()
-        ##########################
-        ### START CODING HERE ####
-        ##########################
-        # Run (PSI-)BLAST for all query proteins.
-        # Store all the uniprot IDs in the uniprot_ids.
-        # Parse and store the blast result in the blast_dict.
-        line = clean_uniprot(line)
-        blast_result = blast(db=db, query=line + ".fasta", query_folder=query_folder, blast_path=output_filename, psiblast=psiblast,evalue=evalue)
-        uniprot_ids.append(line)
-        blast_dict = parse_blast_result(blast_result=blast_result, blast_dict=blast_dict)
+    # blast_hits will be used to store all protein pairs and the corresponding e-values (see BlastHits).
+    blast_hits = new_blast_hits(uniprot_ids)
 
-        ##########################
-        ###  END CODING HERE  ####
-        ##########################
+    # Hits of earlier runs with the same database, settings and query sequences are cached next to
+    # the output file, so only the queries that were not (PSI-)BLASTed before have to be run.
+    cache = None
+    missing_ids = uniprot_ids
+    if use_cache:
+        cache = open_blast_cache(output_filename + ".cache.db")
+        cache_params = get_cache_params(db, evalue, psiblast, max_target_seqs, pssm_cache)
+        query_params = {uniprot_id: get_query_params(cache_params, os.path.join(query_folder, uniprot_id + ".fasta"))
+                        for uniprot_id in uniprot_ids}
+        missing_ids = load_cached_hits(cache, query_params, blast_hits)
+
+    # BLAST scales poorly with threads, so the queries are split in one multi-fasta chunk
+    # per CPU and every chunk is BLASTed by its own process. Only when there are fewer
+    # queries than CPUs, the remaining CPUs are handed out as BLAST threads.
+    # The qacc column of the tabular output tells the hits of the different queries apart.
+    # PSI-BLAST builds one profile per query, so there every query is run on its own instead.
+    threads = threads or os.cpu_count() or 1
+    workers = max(1, min(threads, len(missing_ids)))
+    num_threads = max(1, threads // workers)
+    with tempfile.TemporaryDirectory() as chunk_folder, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Each job is a query file together with the UniProt IDs it contains.
+        if psiblast:
+            jobs = [(os.path.join(query_folder, uniprot_id + ".fasta"), [uniprot_id]) for uniprot_id in missing_ids]
+            if pssm_cache is not None:
+                os.makedirs(pssm_cache, exist_ok=True)
+        else:
+            jobs = []
+            for i in range(min(workers, len(missing_ids))):
+                chunk_fasta = os.path.join(chunk_folder, "queries_" + str(i) + ".fasta")
+                concatenate_queries(query_folder, missing_ids[i::workers], chunk_fasta)
+                jobs.append((chunk_fasta, missing_ids[i::workers]))
+        futures = {executor.submit(blast, db, query_file, "", psiblast, evalue, num_threads, pssm_cache,
+                                   max_target_seqs): job_ids
+                   for query_file, job_ids in jobs}
+        # Collect the parsed hits in the main process as they come in, so blast_hits needs no locking.
+        for future in concurrent.futures.as_completed(futures):
+            hits = future.result()
+            add_hits(blast_hits, ((query, subject, e_value) for (query, subject), e_value in hits.items()))
+            if cache is not None:
+                store_hits(cache, query_params, futures[future], hits)
+    if cache is not None:
+        cache.close()
 
-    uniprot_ids_file.close()
-    write_output(uniprot_ids, output_filename, blast_dict)
-    plot_evalue_distribution(blast_dict, output_png)
+    write_output(uniprot_ids, output_filename, blast_hits, sparse)
+    if output_png:
+        plot_evalue_distribution(blast_hits.evalues, output_png, evalue)
 
 
 if __name__ == "__main__":
@@ -198,7 +513,16 @@ if __name__ == "__main__":
     parser.add_argument("-opng", "--output_png", help="output png file", required=False)
     parser.add_argument("-psi", "--psiblast", dest="psiblast", action="store_true", help="If flagged, run PSI-BLAST instead of BLASTP")
     #Adding an evalue threshold command line argument
-    parser.add_argument("-eval", "--evalue", required=False, default=10)
+    parser.add_argument("-eval", "--evalue", required=False, default=10.0, type=float)
+    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count(), help="number of CPUs used by (PSI-)BLAST")
+    parser.add_argument("-pssm", "--pssm_cache", required=False,
+                        help="folder to save PSI-BLAST profiles (PSSMs) in and reuse them in later runs")
+    parser.add_argument("-max", "--max_target_seqs", "--max-target-seqs", type=int, required=False,
+                        help="maximum number of hits per query (default: the default of (PSI-)BLAST)")
+    parser.add_argument("-sparse", "--sparse", action="store_true",
+                        help="If flagged, only write protein pairs with a hit; missing pairs are implicitly NA")
+    parser.add_argument("-nocache", "--no_cache", dest="use_cache", action="store_false",
+                        help="If flagged, do not reuse or save (PSI-)BLAST hits in <output_file>.cache.db")
     
     args = parser.parse_args()
 
@@ -212,6 +536,12 @@ if __name__ == "__main__":
     output_filename = args.output_file
     output_png = args.output_png
     evalue = args.evalue
+    threads = args.threads
+    pssm_cache = args.pssm_cache
+    max_target_seqs = args.max_target_seqs
+    sparse = args.sparse
+    use_cache = args.use_cache
     
-    main(uniprot_id_list, query_folder, db, psiblast, output_filename, output_png, evalue)
+    main(uniprot_id_list, query_folder, db, psiblast, output_filename, output_png, evalue, threads, pssm_cache,
+         max_target_seqs, sparse, use_cache)
 